@@ -1,34 +1,100 @@
-from flask import Flask, jsonify
+from flask import Flask, request
 from flask_cors import CORS
 import requests
-from bs4 import BeautifulSoup
-from datetime import datetime, timedelta
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+from lxml import html
+from datetime import datetime
+from zoneinfo import ZoneInfo
 import os
-import json
+import re
+import hashlib
+import orjson
 from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.executors.pool import ThreadPoolExecutor
 import firebase_admin
 from firebase_admin import credentials, firestore
 import logging
-import pytz
 import time
 import random
+import tempfile
+import threading
+import warnings
+try:
+    import fcntl
+except ImportError:  # Windows (desarrollo local): sin flock, se asume un solo proceso
+    fcntl = None
 
 # Configuración de logs
-logging.basicConfig(level=logging.INFO)
+# El timestamp lo pone el Formatter (solo si el nivel está habilitado), no cada f-string
+logging.basicConfig(
+    level=logging.INFO,
+    format='[%(asctime)s] %(levelname)s %(name)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)
 
-VENEZUELA_TZ = pytz.timezone("America/Caracas")
+VENEZUELA_TZ = ZoneInfo("America/Caracas")
 
 # Variables globales en memoria (Cache temporal)
 current_rates_in_memory = {}
 historical_rates_in_memory = []
 db = None
+# Referencias a los documentos de Firestore (se crean una vez, tras inicializar db)
+CURRENT_DOC_REF = None
+HISTORY_DOC_REF = None
+
+# Los jobs del scheduler publican estado nuevo mientras los handlers de Flask leen:
+# se arma todo fuera del lock y se intercambian las referencias de una sola vez.
+_state_lock = threading.Lock()
+
+# Momento (time.monotonic) de la última publicación de estado (carga o escritura)
+_last_load_ts = 0.0
+# Este proceso ya leyó Firestore al menos una vez con éxito
+_rates_loaded_once = False
+# Hay una recarga en segundo plano en curso (protegido por _refresh_lock)
+_refresh_lock = threading.Lock()
+_refresh_in_flight = False
+# Serializa las corridas de update_rates_logic: max_instances=1 es por job, y el job
+# USDT de las 00:00 puede solaparse con el diario de las 00:01 si Binance tarda
+_update_lock = threading.Lock()
+# Watches de Firestore (on_snapshot) de este proceso
+_snapshot_watches = []
+# Documentos cuyo primer snapshot ya llegó; con ambos la memoria cuenta como cargada
+_snapshots_seen = set()
+
+# Corridas seguidas sin cambios en las tasas (para espaciar escrituras)
+_unchanged_runs = 0
+
+# Validadores HTTP de la última página del BCV procesada (GET condicional)
+_bcv_validators = {}
+
+# Respuestas JSON ya serializadas + ETag (se reconstruyen solo cuando cambian los datos).
+# Cada una es una tupla (body, etag) para que ambos se publiquen juntos.
+_rates_payload = (b"{}", hashlib.blake2b(b"{}", digest_size=8).hexdigest())
+_history_payload = (b"[]", hashlib.blake2b(b"[]", digest_size=8).hexdigest())
 
 # --- CONSTANTES ---
 BCV_URL = "https://www.bcv.org.ve/"
+# XPath precompilado para el scraping del BCV (libxml2 en C, sin árbol de BeautifulSoup):
+# un solo recorrido del documento devuelve los contenedores de dólar y euro
+_RATE_DIVS_XP = html.etree.XPath("//div[@id='dolar' or @id='euro']")
+_NUM_RE = re.compile(r'\d[\d.,]*')
+_STRFTIME_FMT = "%Y-%m-%d %H:%M:%S"
+# Campos que definen si una actualización cambió algo
+_RATE_FIELDS = ("usd", "eur", "usdt", "usd_change_percent", "eur_change_percent")
+# Con tasas sin cambios, solo se persiste 1 de cada N corridas (refresca last_updated)
+UNCHANGED_WRITE_EVERY = 4
+# Nombres de meses para las fechas del historial (sin depender del locale del proceso)
+MESES_ES = ("Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre")
+# Días de historial que se conservan
+HISTORY_MAX_DAYS = 30
+# Segundos que los endpoints sirven desde memoria antes de volver a leer Firestore
+CACHE_TTL = 60
 DEFAULT_RATES = {
     "usd": 0.01,
     "eur": 0.01,
@@ -39,37 +105,90 @@ DEFAULT_RATES = {
     "usdt_change_percent": 0.0
 }
 
+# --- SESIÓN HTTP (Keep-Alive compartido entre jobs) ---
+SESSION = requests.Session()
+_HTTP_ADAPTER = HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504]))
+SESSION.mount('https://', _HTTP_ADAPTER)
+SESSION.mount('http://', _HTTP_ADAPTER)
+SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
+
+# El BCV sirve una cadena TLS incompleta. Si existe un bundle con su CA intermedia
+# (bcv_ca.pem junto a app.py, o la ruta en BCV_CA_BUNDLE) se verifica contra él;
+# si no, se mantiene verify=False y se avisa una vez al arrancar. El InsecureRequestWarning
+# se ignora solo para el host del BCV: los demás hosts sin verificar siguen avisando.
+_BCV_CA_BUNDLE = os.environ.get('BCV_CA_BUNDLE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bcv_ca.pem'))
+BCV_VERIFY = _BCV_CA_BUNDLE if os.path.isfile(_BCV_CA_BUNDLE) else False
+if BCV_VERIFY is False:
+    logger.warning(f"Verificación TLS del BCV desactivada: no se encontró el bundle {_BCV_CA_BUNDLE}.")
+    warnings.filterwarnings('ignore', category=urllib3.exceptions.InsecureRequestWarning, message=r".*'www\.bcv\.org\.ve'")
+
 # --- INICIALIZACIÓN FIREBASE ---
 try:
     firebase_credentials_json = os.environ.get('FIREBASE_CREDENTIALS_JSON')
     if firebase_credentials_json and not firebase_admin._apps:
-        cred = credentials.Certificate(json.loads(firebase_credentials_json)) 
+        cred = credentials.Certificate(orjson.loads(firebase_credentials_json)) 
         firebase_admin.initialize_app(cred)
         db = firestore.client()
+        CURRENT_DOC_REF = db.collection('rates').document('current')
+        HISTORY_DOC_REF = db.collection('rates').document('history')
         logger.info("Firebase inicializado correctamente.")
     elif not firebase_credentials_json:
          logger.warning("ADVERTENCIA: No se encontró variable 'FIREBASE_CREDENTIALS_JSON'.")
 except Exception as e:
     logger.error(f"ERROR Firebase: {e}")
 
+# --- AUXILIAR: Publicar estado en memoria + respuestas serializadas ---
+def _publish_state(current=None, history=None):
+    # None = conservar lo publicado (los listeners de Firestore actualizan un documento a la vez)
+    global current_rates_in_memory, historical_rates_in_memory, _rates_payload, _history_payload, _last_load_ts
+    # Serializar fuera del lock; bajo el lock se intercambian juntos los datos y el payload de
+    # cada documento. Current e historial se reemplazan por separado (cada listener publica el
+    # suyo), así que por un instante pueden venir de escrituras distintas.
+    rates_payload = _build_payload(current) if current is not None else None
+    history_payload = _build_payload(history) if history is not None else None
+    with _state_lock:
+        if current is not None:
+            current_rates_in_memory = current
+            _rates_payload = rates_payload
+        if history is not None:
+            historical_rates_in_memory = history
+            _history_payload = history_payload
+        _last_load_ts = time.monotonic()
+
+def _build_payload(data):
+    body = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    return body, hashlib.blake2b(body, digest_size=8).hexdigest()
+
+def _cached_json_response(payload, max_age=60):
+    body, etag = payload
+    resp = app.response_class(body, mimetype='application/json')
+    resp.headers['Cache-Control'] = f'public, max-age={max_age}'
+    resp.set_etag(etag)
+    # Si el cliente manda If-None-Match con el mismo ETag, responde 304 sin cuerpo
+    return resp.make_conditional(request)
+
 # --- FUNCIÓN: Cargar datos desde Firestore (Sincronización) ---
 def load_rates_from_firestore():
-    global current_rates_in_memory, historical_rates_in_memory
+    global _rates_loaded_once
     if db:
         try:
+            # Tasas Actuales + Historial en una sola llamada BatchGetDocuments (1 RPC en vez de 2)
+            snapshots = {snap.id: snap for snap in db.get_all([CURRENT_DOC_REF, HISTORY_DOC_REF])}
+
             # Cargar Tasas Actuales
-            doc = db.collection('rates').document('current').get()
-            if doc.exists:
-                current_rates_in_memory = doc.to_dict()
+            doc = snapshots.get('current')
+            if doc is not None and doc.exists:
+                current = doc.to_dict()
             else:
-                current_rates_in_memory = DEFAULT_RATES.copy()
+                current = DEFAULT_RATES.copy()
 
             # Cargar Historial
-            hist_doc = db.collection('rates').document('history').get()
-            if hist_doc.exists and 'data' in hist_doc.to_dict():
-                historical_rates_in_memory = hist_doc.to_dict()['data']
-            else:
-                historical_rates_in_memory = []
+            hist_doc = snapshots.get('history')
+            hist_data = hist_doc.to_dict() if hist_doc is not None and hist_doc.exists else {}
+            history = hist_data.get('data', [])
+
+            _publish_state(current, history)
+            _rates_loaded_once = True
                 
         except Exception as e:
             logger.error(f"Error cargando Firestore: {e}")
@@ -80,7 +199,6 @@ def fetch_binance_usdt():
     
     url = "https://p2p.binance.com/bapi/c2c/v2/friendly/c2c/adv/search"
     headers = {
-        "User-Agent": "Mozilla/5.0",
         "Content-Type": "application/json",
         "Clienttype": "web"
     }
@@ -106,11 +224,11 @@ def fetch_binance_usdt():
                 "payTypes": []               # EL SECRETO: Vacío para que lea Banesco, Provincial, BDV, etc.
             }
             time.sleep(random.uniform(0.5, 1.0))
-            response = requests.post(url, json=payload, headers=headers, timeout=10)
+            response = SESSION.post(url, json=payload, headers=headers, timeout=10)
             
+            prices = []
             if response.status_code == 200:
-                data = response.json()
-                prices = []
+                data = orjson.loads(response.content)
                 
                 if data.get("code") == "000000" and "data" in data:
                     for ad in data["data"]:
@@ -130,7 +248,7 @@ def fetch_binance_usdt():
                 precios_solidos = prices[0:3] 
                 avg = sum(precios_solidos) / len(precios_solidos)
                 averages[trade_type] = avg
-                logger.info(f"Espejo App {trade_type} (>100$): {precios_solidos} -> Promedio: {avg}")
+                logger.debug("Espejo App %s (>100$): %s -> Promedio: %s", trade_type, precios_solidos, avg)
             elif prices:
                 avg = sum(prices) / len(prices)
                 averages[trade_type] = avg
@@ -147,23 +265,145 @@ def fetch_binance_usdt():
         logger.error(f"Error Binance: {e}")
         return None
 
+# --- AUXILIAR: Extraer las tasas del HTML del BCV ---
+def _extract_bcv_rates(tree):
+    # Devuelve {'dolar': float, 'euro': float} con las tasas válidas encontradas.
+    # Por cada id gana el primer div con un valor válido; un div ilegible no descarta al otro.
+    rates = {}
+    for div in _RATE_DIVS_XP(tree):
+        div_id = div.get('id')
+        strong = div.find('.//strong')
+        if div_id in rates or strong is None:
+            continue
+        match = _NUM_RE.search(strong.text_content())
+        if not match:
+            continue
+        try:
+            value = float(match.group().replace(',', '.'))
+        except ValueError:
+            logger.warning(f"Valor BCV ilegible en #{div_id}: {match.group()!r}")
+            continue
+        if value > 0:
+            rates[div_id] = value
+    return rates
+
 # --- AUXILIAR: Formatear Fecha en Español ---
-def get_current_date_string():
-    now = datetime.now(VENEZUELA_TZ)
-    meses_es = ["Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio", "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre"]
-    return f"{now.day} de {meses_es[now.month - 1]} de {now.year}"
+def get_current_date_string(now=None):
+    now = now or datetime.now(VENEZUELA_TZ)
+    return f"{now.day} de {MESES_ES[now.month - 1]} de {now.year}"
+
+# --- AUXILIAR: ¿La entrada del historial corresponde a hoy? ---
+def _is_entry_for(entry, date_iso, date_str):
+    # Las entradas nuevas traen 'date_iso' (YYYY-MM-DD); las antiguas solo la fecha en español
+    if 'date_iso' in entry:
+        return entry['date_iso'] == date_iso
+    return entry.get('date') == date_str
+
+# --- AUXILIAR: Variación porcentual contra el cierre anterior ---
+def _recompute_percent(current, previous):
+    if not previous or previous <= 0:
+        return 0.0
+    return ((current - previous) / previous) * 100.0
+
+# --- AUXILIAR: ¿Las tasas nuevas son iguales a las anteriores? ---
+def _rates_unchanged(old, new):
+    for key in _RATE_FIELDS:
+        old_value = old.get(key)
+        if old_value is None or abs(new[key] - old_value) >= 1e-6:
+            return False
+    return True
+
+# --- FUNCIÓN: Listeners de Firestore (push en vez de polling) ---
+def _mark_snapshot_seen(name):
+    # Tras el primer snapshot de ambos documentos ya no hace falta la carga síncrona (get_all)
+    global _rates_loaded_once
+    _snapshots_seen.add(name)
+    if len(_snapshots_seen) == 2:
+        _rates_loaded_once = True
+
+def _on_current_snapshot(doc_snapshots, changes, read_time):
+    try:
+        doc = doc_snapshots[0] if doc_snapshots else None
+        _publish_state(current=doc.to_dict() if doc is not None and doc.exists else DEFAULT_RATES.copy())
+        _mark_snapshot_seen('current')
+    except Exception as e:
+        logger.error(f"Error en listener de tasas: {e}")
+
+def _on_history_snapshot(doc_snapshots, changes, read_time):
+    try:
+        doc = doc_snapshots[0] if doc_snapshots else None
+        data = doc.to_dict() if doc is not None and doc.exists else {}
+        _publish_state(history=data.get('data', []))
+        _mark_snapshot_seen('history')
+    except Exception as e:
+        logger.error(f"Error en listener de historial: {e}")
+
+def start_snapshot_listeners():
+    # Cada worker mantiene su memoria al día vía un stream gRPC; sin lecturas periódicas
+    global _snapshot_watches
+    if not db or _snapshot_watches:
+        return
+    try:
+        _snapshot_watches = [
+            CURRENT_DOC_REF.on_snapshot(_on_current_snapshot),
+            HISTORY_DOC_REF.on_snapshot(_on_history_snapshot),
+        ]
+    except Exception as e:
+        logger.error(f"Error iniciando listeners Firestore: {e}")
+
+def _listeners_active():
+    return bool(_snapshot_watches) and all(watch.is_active for watch in _snapshot_watches)
+
+# --- FUNCIÓN: Recargar desde Firestore solo si la memoria está vencida ---
+def load_rates_if_stale():
+    # Stale-while-revalidate: la petición responde con lo que hay en memoria y la
+    # recarga corre en un hilo aparte. Solo la primera carga del proceso es síncrona.
+    global _refresh_in_flight
+    if not _rates_loaded_once:
+        load_rates_from_firestore()
+        return
+    # Con los listeners vivos la memoria ya está al día; el TTL queda como respaldo si el stream cae
+    if _listeners_active():
+        return
+    if time.monotonic() - _last_load_ts <= CACHE_TTL:
+        return
+    with _refresh_lock:
+        if _refresh_in_flight:
+            return
+        _refresh_in_flight = True
+    threading.Thread(target=_background_refresh, name='rates-refresh', daemon=True).start()
+
+def _background_refresh():
+    global _refresh_in_flight
+    try:
+        load_rates_from_firestore()
+    finally:
+        with _refresh_lock:
+            _refresh_in_flight = False
 
 # --- LÓGICA DE ACTUALIZACIÓN ---
 def update_rates_logic(only_usdt=False):
-    global current_rates_in_memory, historical_rates_in_memory
+    # Una corrida a la vez: cada una parte del estado que publicó la anterior
+    with _update_lock:
+        _update_rates(only_usdt)
+
+def _update_rates(only_usdt):
+    global _unchanged_runs
     
-    # 1. Sincronizar estado actual
-    load_rates_from_firestore()
+    # 1. Sincronizar estado actual. La corrida diaria siempre relee Firestore (1 RPC al día):
+    # el historial se reescribe completo, así que debe partir de lo persistido y no de la memoria.
+    # Las de USDT solo necesitan la primera carga; luego usan lo que publicó la corrida anterior.
+    if not only_usdt or not _rates_loaded_once:
+        load_rates_from_firestore()
     
+    # Snapshot del estado: el resto de la función trabaja sobre estas referencias
+    previous_rates = current_rates_in_memory
+    history = historical_rates_in_memory
+
     # Valores actuales antes de actualizar
-    usd_rate = current_rates_in_memory.get('usd', 0.01)
-    eur_rate = current_rates_in_memory.get('eur', 0.01)
-    usdt_rate = current_rates_in_memory.get('usdt', 0.01)
+    usd_rate = previous_rates.get('usd', 0.01)
+    eur_rate = previous_rates.get('eur', 0.01)
+    usdt_rate = previous_rates.get('usdt', 0.01)
 
     # 2. Actualizar USDT (Siempre corre)
     new_usdt = fetch_binance_usdt()
@@ -174,27 +414,42 @@ def update_rates_logic(only_usdt=False):
     # Se ejecuta si no es "only_usdt"
     if not only_usdt:
         try:
-            resp = requests.get(BCV_URL, timeout=30, verify=False) 
-            if resp.status_code == 200:
-                soup = BeautifulSoup(resp.text, 'lxml')
+            conditional_headers = {}
+            if _bcv_validators.get('etag'):
+                conditional_headers['If-None-Match'] = _bcv_validators['etag']
+            if _bcv_validators.get('last_modified'):
+                conditional_headers['If-Modified-Since'] = _bcv_validators['last_modified']
+
+            resp = SESSION.get(BCV_URL, headers=conditional_headers, timeout=(5, 30), verify=BCV_VERIFY) 
+            if resp.status_code == 304:
+                # La página no cambió desde el último scraping: las tasas en memoria siguen vigentes
+                logger.info("BCV sin cambios (304), se omite el parseo.")
+            elif resp.status_code == 200:
+                tree = html.fromstring(resp.content)
                 
                 # Extraer tasas numéricas
-                usd_div = soup.find('div', id='dolar')
-                if usd_div: 
-                    raw_usd = float(usd_div.find('strong').text.strip().replace(',', '.'))
-                    if raw_usd > 0: usd_rate = raw_usd
-
-                eur_div = soup.find('div', id='euro')
-                if eur_div: 
-                    raw_eur = float(eur_div.find('strong').text.strip().replace(',', '.'))
-                    if raw_eur > 0: eur_rate = raw_eur
+                bcv_rates = _extract_bcv_rates(tree)
+                raw_usd = bcv_rates.get('dolar')
+                if raw_usd: usd_rate = raw_usd
+
+                raw_eur = bcv_rates.get('euro')
+                if raw_eur: eur_rate = raw_eur
+
+                # Solo se recuerdan los validadores de una página que se pudo leer completa
+                if raw_usd and raw_eur:
+                    _bcv_validators['etag'] = resp.headers.get('ETag')
+                    _bcv_validators['last_modified'] = resp.headers.get('Last-Modified')
                 
                 # NOTA: Ya no bloqueamos por fecha futura. Tomamos el valor que esté en la web.
+        except requests.exceptions.RequestException as e:
+            # Error de red: las tasas anteriores siguen siendo válidas
+            logger.error(f"Error BCV (red): {e}")
         except Exception as e:
-            logger.error(f"Error BCV: {e}")
+            logger.error(f"Error BCV (parseo): {e}")
 
     now_vzla = datetime.now(VENEZUELA_TZ)
-    today_str = get_current_date_string()
+    today_str = get_current_date_string(now_vzla)
+    today_iso = now_vzla.date().isoformat()
 
     # --- CÁLCULO DE PORCENTAJES (CORREGIDO) ---
     # Para calcular el porcentaje real, necesitamos comparar la tasa NUEVA (usd_rate)
@@ -203,22 +458,23 @@ def update_rates_logic(only_usdt=False):
     prev_usd = usd_rate # Fallback por defecto
     prev_eur = eur_rate
     
-    # Buscamos en el historial una entrada que NO sea la de hoy
-    if historical_rates_in_memory:
-        # Recorremos el historial para encontrar el primer registro que tenga una fecha diferente a hoy
-        for entry in historical_rates_in_memory:
-            if entry.get('date') != today_str:
-                prev_usd = entry.get('usd', usd_rate)
-                prev_eur = entry.get('eur', eur_rate)
-                break
+    # Buscamos en el historial una entrada que NO sea la de hoy.
+    # El historial está ordenado de más reciente a más antiguo y hay una entrada por día,
+    # así que el cierre anterior es [0] o, si [0] ya es hoy, [1].
+    prev_entry = None
+    if history:
+        if not _is_entry_for(history[0], today_iso, today_str):
+            prev_entry = history[0]
+        elif len(history) > 1:
+            prev_entry = history[1]
+
+    if prev_entry:
+        prev_usd = prev_entry.get('usd', usd_rate)
+        prev_eur = prev_entry.get('eur', eur_rate)
     
     # Calcular Porcentajes
-    try:
-        usd_change = ((usd_rate - prev_usd) / prev_usd) * 100 if prev_usd > 0 else 0.0
-        eur_change = ((eur_rate - prev_eur) / prev_eur) * 100 if prev_eur > 0 else 0.0
-    except:
-        usd_change = 0.0
-        eur_change = 0.0
+    usd_change = _recompute_percent(usd_rate, prev_usd)
+    eur_change = _recompute_percent(eur_rate, prev_eur)
 
     # Guardar objeto Current
     new_data = {
@@ -226,50 +482,72 @@ def update_rates_logic(only_usdt=False):
         "eur": eur_rate,
         "usdt": usdt_rate,
         "ut": 43.00,
-        "last_updated": now_vzla.strftime("%Y-%m-%d %H:%M:%S"),
+        "last_updated": now_vzla.strftime(_STRFTIME_FMT),
         "usd_change_percent": round(usd_change, 2),
         "eur_change_percent": round(eur_change, 2),
         "usdt_change_percent": 0.0
     }
     
-    current_rates_in_memory = new_data
+    # Historial (Solo si es la rutina diaria BCV, no la de USDT solo).
+    # Se arma una lista nueva en vez de mutar la que están leyendo los handlers.
+    history_changed = False
+    if not only_usdt:
+        new_hist_entry = {
+            "date": today_str,
+            "date_iso": today_iso,
+            "usd": usd_rate,
+            "eur": eur_rate,
+            "usdt": usdt_rate
+        }
+
+        # Verificar si ya existe una entrada para "Hoy" (basado en fecha calendario Vzla)
+        if history and _is_entry_for(history[0], today_iso, today_str):
+            # Si ya corrió hoy, reemplazamos el valor solo si cambió algo
+            if history[0] != new_hist_entry:
+                history = [new_hist_entry] + history[1:]
+                history_changed = True
+        else:
+            # Si es un nuevo día, insertamos al principio
+            history = [new_hist_entry] + history
+            history_changed = True
+
+        # Mantener solo los últimos 30 días para no saturar
+        history = history[:HISTORY_MAX_DAYS]
+
+    # Si las tasas no se movieron, no reescribimos Firestore en cada corrida.
+    # El contador solo avanza si la corrida termina bien (ver abajo).
+    unchanged_runs = 0
+    write_current = True
+    if _rates_unchanged(previous_rates, new_data):
+        unchanged_runs = _unchanged_runs + 1
+        write_current = unchanged_runs % UNCHANGED_WRITE_EVERY == 0
 
     # --- ACTUALIZAR FIREBASE ---
-    if db:
+    if db and (write_current or history_changed):
         try:
-            # 1. Guardar Current
-            db.collection('rates').document('current').set(current_rates_in_memory)
-            
-            # 2. Lógica de Historial (Solo si es la rutina diaria BCV, no la de USDT solo)
-            if not only_usdt:
-                # Verificar si ya existe una entrada para "Hoy" (basado en fecha calendario Vzla)
-                entry_exists_for_today = False
-                if historical_rates_in_memory and historical_rates_in_memory[0]['date'] == today_str:
-                    entry_exists_for_today = True
-
-                new_hist_entry = {
-                    "date": today_str,
-                    "usd": usd_rate,
-                    "eur": eur_rate,
-                    "usdt": usdt_rate
-                }
-
-                if entry_exists_for_today:
-                    # Si ya corrió hoy, actualizamos el valor (por si cambió algo)
-                    historical_rates_in_memory[0] = new_hist_entry
-                else:
-                    # Si es un nuevo día, insertamos al principio
-                    historical_rates_in_memory.insert(0, new_hist_entry)
-
-                # Mantener solo los últimos 30 días para no saturar
-                historical_rates_in_memory = historical_rates_in_memory[:30]
-                
-                # Guardar Historial
-                db.collection('rates').document('history').set({'data': historical_rates_in_memory})
+            # Un solo batch: Current e Historial se confirman juntos (atómico, 1 RPC),
+            # así un fallo a mitad de camino no deja un documento actualizado y el otro no.
+            batch = db.batch()
+            if write_current:
+                batch.set(CURRENT_DOC_REF, new_data)
+            if history_changed:
+                batch.set(HISTORY_DOC_REF, {'data': history})
+            batch.commit()
+
+            if history_changed:
                 logger.info(f"Historial actualizado para fecha: {today_str}")
 
         except Exception as e:
+            # La memoria sigue en lo persistido: la próxima corrida compara contra eso y reintenta
             logger.error(f"Error escribiendo Firestore: {e}")
+            return
+
+    # Solo se publica lo que se persiste: con la escritura omitida se mantiene el current
+    # anterior (y su last_updated), igual al que los demás workers reciben de Firestore.
+    # La corrida de USDT no toca el historial: no se republica la copia tomada al inicio.
+    _unchanged_runs = unchanged_runs
+    _publish_state(current=new_data if write_current else None,
+                   history=None if only_usdt else history)
 
 # Jobs del Scheduler
 def job_daily_bcv():
@@ -286,27 +564,103 @@ def job_usdt_update():
 def index():
     return "API Kmbio Vzla v3.0 (Continuous Daily History)", 200
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    # Para health checks / pingers externos: sin Firestore ni serialización
+    return app.response_class(b"ok", mimetype='text/plain')
+
 @app.route('/api/bcv-rates', methods=['GET'])
 def get_rates():
-    load_rates_from_firestore() 
-    return jsonify(current_rates_in_memory)
+    load_rates_if_stale()
+    return _cached_json_response(_rates_payload)
 
 @app.route('/api/bcv-history', methods=['GET'])
 def get_history():
-    load_rates_from_firestore()
-    return jsonify(historical_rates_in_memory)
+    load_rates_if_stale()
+    # El historial solo cambia una vez al día
+    return _cached_json_response(_history_payload, max_age=300)
 
-if __name__ != '__main__':
+# --- SCHEDULER (una sola instancia por máquina) ---
+scheduler = None
+SCHEDULER_LOCK_PATH = os.path.join(tempfile.gettempdir(), 'kmbio-scheduler.lock')
+_scheduler_lock_file = None
+# Cada cuánto un worker sin scheduler reintenta tomar el flock
+SCHEDULER_RETRY_SECONDS = 60
+_scheduler_watcher = None
+
+def _acquire_scheduler_lock():
+    # Con varios workers de gunicorn, solo el que obtiene el flock corre los jobs.
+    # El lock se libera cuando el proceso muere; los demás workers lo reintentan (ver _scheduler_watch).
+    global _scheduler_lock_file
+    if fcntl is None:
+        return True
+    lock_file = None
     try:
-        load_rates_from_firestore()
-        scheduler = BackgroundScheduler(timezone="America/Caracas")
-        if not scheduler.running:
-            # CAMBIO: day_of_week='mon-sun' para que corra sábados y domingos
-            scheduler.add_job(job_daily_bcv, 'cron', day_of_week='mon-sun', hour=0, minute=1)
-            scheduler.add_job(job_usdt_update, 'cron', minute='0,15,30,45')
-            scheduler.start()
+        # open() también puede fallar (tmp de solo lectura o archivo de otro usuario)
+        lock_file = open(SCHEDULER_LOCK_PATH, 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        if lock_file is not None:
+            lock_file.close()
+        return False
+    _scheduler_lock_file = lock_file
+    return True
+
+def _release_scheduler_lock():
+    # Si el scheduler no arrancó, otro worker debe poder tomar el lock
+    global _scheduler_lock_file
+    if _scheduler_lock_file is not None:
+        _scheduler_lock_file.close()
+        _scheduler_lock_file = None
+
+def start_scheduler():
+    global scheduler
+    if scheduler is not None:
+        return
+    # RUN_SCHEDULER=0 permite instancias que solo sirven la API (p.ej. réplicas extra)
+    if os.environ.get('RUN_SCHEDULER', '1') != '1':
+        logger.info("RUN_SCHEDULER desactivado; este proceso solo sirve la API.")
+        return
+    if not _acquire_scheduler_lock():
+        # En un HUP de gunicorn los workers nuevos arrancan antes de que salga el que tiene
+        # el lock: se sigue reintentando para que alguno retome los jobs cuando se libere
+        if _scheduler_watcher is None:
+            logger.info("Scheduler ya activo en otro worker; este proceso solo sirve la API.")
+            _start_scheduler_watcher()
+        return
+    try:
+        # coalesce + max_instances=1: tras una pausa (cold start) no se re-ejecutan disparos atrasados en cadena
+        scheduler = BackgroundScheduler(
+            timezone=VENEZUELA_TZ,
+            # Pocos jobs y todos I/O: 4 hilos bastan para que un scraping lento no retrase a los demás
+            executors={'default': ThreadPoolExecutor(max_workers=4)},
+            job_defaults={'coalesce': True, 'max_instances': 1, 'misfire_grace_time': 60}
+        )
+        # CAMBIO: day_of_week='mon-sun' para que corra sábados y domingos
+        # misfire_grace_time=3600: si el proceso reinicia en la madrugada, el job de las 00:01 aún corre una vez
+        scheduler.add_job(job_daily_bcv, 'cron', day_of_week='mon-sun', hour=0, minute=1, misfire_grace_time=3600)
+        scheduler.add_job(job_usdt_update, 'cron', minute='0,15,30,45', jitter=30)
+        scheduler.start()
     except Exception as e:
         logger.error(f"Error scheduler: {e}")
+        scheduler = None
+        _release_scheduler_lock()
+
+def _scheduler_watch():
+    while scheduler is None:
+        time.sleep(SCHEDULER_RETRY_SECONDS)
+        start_scheduler()
+    logger.info("Scheduler tomado por este worker.")
+
+def _start_scheduler_watcher():
+    global _scheduler_watcher
+    _scheduler_watcher = threading.Thread(target=_scheduler_watch, name='scheduler-lock', daemon=True)
+    _scheduler_watcher.start()
+
+# Bajo gunicorn (wsgi:app) el módulo se importa una vez por worker; el flock deja un solo scheduler
+if __name__ != '__main__':
+    start_snapshot_listeners()
+    start_scheduler()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
\ No newline at end of file
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))